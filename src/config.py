@@ -1,19 +1,61 @@
 """Configuration and utilities for Snapchat media mapper."""
 
+import ctypes
+import errno
 import json
 import logging
 import os
 import shutil
-from dataclasses import dataclass, field
+import stat
+import sys
+from concurrent.futures import ThreadPoolExecutor
+from dataclasses import asdict, dataclass, field, is_dataclass
 from pathlib import Path
 from datetime import datetime, timezone
-from typing import Dict, Any, Optional
+from typing import Dict, Any, Iterator, Optional, Set, Tuple
+
+try:
+    import orjson
+except ImportError:  # Fall back to the stdlib json module
+    orjson = None
+
+try:
+    import ijson
+except ImportError:  # Large JSON files are loaded whole instead
+    ijson = None
+
+try:
+    import fcntl
+except ImportError:  # Not available on Windows, reflinks are skipped
+    fcntl = None
 
 # Configuration
 INPUT_DIR = Path("input")
 OUTPUT_DIR = Path("output")
 TIMESTAMP_THRESHOLD_SECONDS = 60
 QUICKTIME_EPOCH_ADJUSTER = 2082844800
+JSON_STREAM_THRESHOLD_MB = 64
+
+# How media is materialized into the output: 'hardlink' (hardlink -> reflink -> copy),
+# 'reflink' (reflink -> copy) or 'copy' (always independent byte copies)
+MATERIALIZE_MODES = ("hardlink", "reflink", "copy")
+MATERIALIZE_MODE = os.environ.get("MATERIALIZE_MODE", "hardlink").lower()
+FICLONE = 0x40049409
+
+# Errors meaning a clone can never succeed between these two filesystems
+# (ENOTSUP is macOS's spelling of EOPNOTSUPP; EINVAL can be per-file, so it isn't cached)
+_CLONE_UNSUPPORTED = {errno.EXDEV, errno.EOPNOTSUPP, errno.ENOTSUP, errno.ENOTTY}
+
+# macOS clonefile(2), looked up once
+_clonefile = None
+if sys.platform == "darwin":
+    try:
+        _clonefile = ctypes.CDLL("/usr/lib/libSystem.dylib", use_errno=True).clonefile
+    except (OSError, AttributeError):
+        pass
+
+# Characters not allowed in output file/folder names
+_FILENAME_STRIP = str.maketrans('', '', '\\/*?:"<>|')
 
 # Logging setup
 logging.basicConfig(
@@ -22,7 +64,10 @@ logging.basicConfig(
 )
 logger = logging.getLogger(__name__)
 
-@dataclass
+# dataclass(slots=True) needs Python 3.10+, older versions get regular dataclasses
+_DATACLASS_SLOTS = {"slots": True} if sys.version_info >= (3, 10) else {}
+
+@dataclass(**_DATACLASS_SLOTS)
 class MediaFile:
     """Represents a media file with its metadata."""
     filename: str
@@ -32,7 +77,19 @@ class MediaFile:
     is_merged: bool = False
     mapping_method: Optional[str] = None
 
-@dataclass
+@dataclass(**_DATACLASS_SLOTS)
+class Participant:
+    """A conversation participant as written to conversation metadata."""
+    username: str
+    display_name: str
+    creation_timestamp: str
+    last_modified_timestamp: str
+    source: str
+    friend_status: str
+    friend_list_section: str
+    is_owner: bool = False
+
+@dataclass(**_DATACLASS_SLOTS)
 class Stats:
     """Centralized statistics tracking."""
     # Merge stats
@@ -52,53 +109,203 @@ def ensure_directory(path: Path) -> None:
     """Ensure directory exists."""
     path.mkdir(parents=True, exist_ok=True)
 
+def parallel_rmtree(path: Path, max_workers: int = 32) -> None:
+    """Remove a directory tree, unlinking its files from a thread pool."""
+    # Like shutil.rmtree, never follow a symlink to somebody else's tree
+    if os.path.islink(path):
+        raise OSError(f"Cannot call rmtree on a symbolic link: {path}")
+
+    def _raise(error: OSError) -> None:
+        raise error
+
+    files = []
+    dirs = []
+    try:
+        for root, dirnames, filenames in os.walk(path, onerror=_raise):
+            dirs.append(root)
+            files.extend(os.path.join(root, name) for name in filenames)
+            # Symlinked directories are not descended into, only unlinked
+            files.extend(os.path.join(root, name) for name in dirnames
+                         if os.path.islink(os.path.join(root, name)))
+
+        with ThreadPoolExecutor(max_workers=max_workers) as executor:
+            list(executor.map(os.unlink, files))
+
+        # os.walk lists parents first, so remove directories in reverse
+        for directory in reversed(dirs):
+            os.rmdir(directory)
+    finally:
+        # Cached listings may describe directories that are now gone
+        _dir_entries.clear()
+
 def load_json(path: Path) -> Dict[str, Any]:
     """Load JSON file, return empty dict on error."""
     if not path.exists():
         logger.error(f"JSON file not found: {path}")
         return {}
     try:
+        if orjson is not None:
+            return orjson.loads(path.read_bytes())
         with open(path, 'r', encoding='utf-8') as f:
             return json.load(f)
     except Exception as e:
         logger.error(f"Failed to load {path}: {e}")
         return {}
 
+def iter_json_items(path: Path) -> Iterator[Tuple[str, Any]]:
+    """
+    Yield top-level (key, value) pairs from a JSON object file.
+    Files above JSON_STREAM_THRESHOLD_MB are parsed incrementally with ijson;
+    a parse error part-way through is re-raised rather than truncating the data.
+    """
+    if (ijson is None or not path.exists() or
+            path.stat().st_size < JSON_STREAM_THRESHOLD_MB * 1024 * 1024):
+        yield from load_json(path).items()
+        return
+
+    try:
+        with open(path, 'rb') as f:
+            # Read strictly front to back: ask for aggressive readahead
+            if hasattr(os, "posix_fadvise"):
+                os.posix_fadvise(f.fileno(), 0, 0, os.POSIX_FADV_SEQUENTIAL)
+            yield from ijson.kvitems(f, '', use_float=True)
+    except Exception as e:
+        logger.error(f"Failed to stream {path}: {e}")
+        raise
+
+def _json_default(obj: Any) -> Any:
+    """Serialize dataclasses (e.g. Participant) for the stdlib json fallback."""
+    if is_dataclass(obj):
+        return asdict(obj)
+    raise TypeError(f"Object of type {type(obj).__name__} is not JSON serializable")
+
 def save_json(data: Dict[str, Any], path: Path) -> None:
     """Save dictionary to JSON file."""
     ensure_directory(path.parent)
-    with open(path, 'w', encoding='utf-8') as f:
-        json.dump(data, f, indent=2, ensure_ascii=False)
+    if orjson is not None:
+        buf = orjson.dumps(data, option=orjson.OPT_INDENT_2 | orjson.OPT_NON_STR_KEYS)
+    else:
+        buf = json.dumps(data, indent=2, ensure_ascii=False,
+                         default=_json_default).encode('utf-8')
+    write_file_bytes(path, buf)
+
+def write_file_bytes(path: Path, buf: bytes) -> None:
+    """Write bytes straight to a raw file descriptor, bypassing Python's buffered I/O."""
+    # 0o666 lets the umask decide, as open() would
+    fd = os.open(path, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o666)
+    try:
+        view = memoryview(buf)
+        while view:
+            # os.write may write less than asked for very large buffers
+            view = view[os.write(fd, view):]
+    finally:
+        os.close(fd)
 
 def sanitize_filename(filename: str) -> str:
     """Remove invalid characters from filename."""
-    import re
-    return re.sub(r'[\\/*?:"<>|]', "", filename)[:255]
+    return filename.translate(_FILENAME_STRIP)[:255]
+
+# Names present in each output directory touched by safe_materialize
+_dir_entries: Dict[Path, Set[str]] = {}
+
+def _directory_entries(directory: Path) -> Set[str]:
+    """Create directory if needed and return the cached set of names in it."""
+    entries = _dir_entries.get(directory)
+    if entries is None:
+        ensure_directory(directory)
+        with os.scandir(directory) as it:
+            entries = {entry.name for entry in it}
+        _dir_entries[directory] = entries
+    return entries
+
+# Device of each directory touched by safe_materialize
+_dir_devices: Dict[Path, int] = {}
+
+# (source device, destination device) pairs where cloning is known to fail
+_no_clone: Set[Tuple[int, int]] = set()
+
+def _directory_device(directory: Path) -> int:
+    """Return the st_dev of a directory, stat'ing it only once."""
+    dev = _dir_devices.get(directory)
+    if dev is None:
+        dev = _dir_devices[directory] = os.stat(directory).st_dev
+    return dev
+
+def reflink(src: Path, dst: Path) -> None:
+    """Clone src to a new file dst using copy-on-write. Raises OSError on failure."""
+    if sys.platform == "darwin":
+        if _clonefile is None:
+            raise OSError(errno.ENOTSUP, "clonefile is not available")
+        if _clonefile(os.fsencode(src), os.fsencode(dst), 0) != 0:
+            err = ctypes.get_errno()
+            raise OSError(err, os.strerror(err), str(dst))
+    else:
+        if fcntl is None:
+            raise OSError(errno.EOPNOTSUPP, "reflink is not supported on this platform")
+        try:
+            with open(src, 'rb') as s, open(dst, 'xb') as d:
+                fcntl.ioctl(d.fileno(), FICLONE, s.fileno())
+        except FileExistsError:
+            raise
+        except OSError:
+            # Remove the empty file we created
+            dst.unlink(missing_ok=True)
+            raise
+
+    # Keep timestamps and mode in line with copy2
+    shutil.copystat(src, dst)
 
 def safe_materialize(src: Path, dst: Path) -> bool:
     """
     Efficiently materialize a file from src to dst.
-    Tries: hardlink -> copy. Returns True on success.
+    Tries: hardlink -> reflink -> copy (see MATERIALIZE_MODE). Returns True on success.
     """
-    ensure_directory(dst.parent)
+    try:
+        entries = _directory_entries(dst.parent)
 
-    # Don't copy if already exists
-    if dst.exists():
-        return True
+        # Don't copy if already exists
+        if dst.name in entries:
+            return True
+
+        if MATERIALIZE_MODE != "copy":
+            devices = (_directory_device(src.parent), _directory_device(dst.parent))
 
-    try:
         # Try hardlink first (instant, no extra space)
-        try:
-            os.link(src, dst)
-            return True
-        except (OSError, NotImplementedError):
-            pass
+        if MATERIALIZE_MODE == "hardlink":
+            try:
+                os.link(src, dst)
+                entries.add(dst.name)
+                return True
+            except FileExistsError:
+                entries.add(dst.name)
+                return True
+            except OSError as e:
+                # A cross-device link means a clone can't work either
+                if e.errno == errno.EXDEV:
+                    _no_clone.add(devices)
+            except NotImplementedError:
+                pass
+
+        # Then a copy-on-write clone (no extra space, independent of src)
+        if MATERIALIZE_MODE != "copy" and devices not in _no_clone:
+            try:
+                reflink(src, dst)
+                entries.add(dst.name)
+                return True
+            except FileExistsError:
+                entries.add(dst.name)
+                return True
+            except OSError as e:
+                if e.errno in _CLONE_UNSUPPORTED:
+                    _no_clone.add(devices)
 
         # Fallback to copy
-        if src.is_file():
+        # copy2 already copies in-kernel (sendfile) on Linux
+        if stat.S_ISREG(os.stat(src).st_mode):
             shutil.copy2(src, dst)
         else:
             shutil.copytree(src, dst)
+        entries.add(dst.name)
         return True
     except Exception as e:
         logger.error(f"Failed to materialize {src} to {dst}: {e}")
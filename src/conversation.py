@@ -2,101 +2,133 @@
 
 import logging
 from datetime import datetime, timezone
-from typing import Dict, List, Any, Optional, Set
+from itertools import chain
+from typing import Dict, Iterable, List, Any, Optional, Set, Tuple
+
+from config import Participant
 
 logger = logging.getLogger(__name__)
 
-def merge_conversations(chat_data: Dict, snap_data: Dict) -> Dict[str, List]:
-    """Merge chat and snap histories."""
+# Default friends-map fields; also the entry for participants not in friends.json
+_NOT_FOUND_FRIEND: Dict[str, Any] = {
+    "Display Name": None,
+    "Creation Timestamp": "N/A",
+    "Last Modified Timestamp": "N/A",
+    "Source": "unknown",
+    "friend_status": "not_found",
+    "friend_list_section": "Not Found"
+}
+
+def message_timestamp(msg: Dict) -> int:
+    """Return a message's creation time in microseconds (0 if missing)."""
+    return int(msg.get("Created(microseconds)") or 0)
+
+def merge_conversations(chat_items: Iterable[Tuple[str, List]],
+                        snap_items: Iterable[Tuple[str, List]]) -> Tuple[Dict[str, List], str]:
+    """
+    Merge chat and snap histories from (conv_id, messages) pairs.
+    Returns the merged conversations and the account owner found along the way.
+    """
     logger.info("Merging chat and snap histories")
     merged = {}
+    owner = None
     
     # Process chat messages
-    for conv_id, messages in chat_data.items():
-        if conv_id not in merged:
-            merged[conv_id] = []
+    for conv_id, messages in chat_items:
         for msg in messages:
             msg["Type"] = "message"
-        merged[conv_id].extend(messages)
+            if owner is None and msg.get("IsSender") and msg.get("From"):
+                owner = msg["From"]
+        merged.setdefault(conv_id, []).extend(messages)
     
     # Process snaps
-    for conv_id, snaps in snap_data.items():
-        if conv_id not in merged:
-            merged[conv_id] = []
+    for conv_id, snaps in snap_items:
         for snap in snaps:
             snap["Type"] = "snap"
-        merged[conv_id].extend(snaps)
+            if owner is None and snap.get("IsSender") and snap.get("From"):
+                owner = snap["From"]
+        merged.setdefault(conv_id, []).extend(snaps)
     
     # Sort by timestamp
-    for conv_id in merged:
-        merged[conv_id].sort(key=lambda x: int(x.get("Created(microseconds)", 0)))
+    for messages in merged.values():
+        messages.sort(key=message_timestamp)
     
     logger.info(f"Merged {len(merged)} conversations")
-    return merged
-
-def determine_account_owner(conversations: Dict[str, List]) -> str:
-    """Determine account owner from messages."""
-    for messages in conversations.values():
-        for msg in messages:
-            if msg.get("IsSender"):
-                owner = msg.get("From")
-                if owner:
-                    logger.info(f"Determined account owner: {owner}")
-                    return owner
+    if owner:
+        logger.info(f"Determined account owner: {owner}")
+    else:
+        logger.warning("Could not determine account owner")
+        owner = "unknown"
+
+    return merged, owner
+
+def build_friends_map(friends_json: Dict) -> Dict[str, Dict]:
+    """Index friends and deleted friends by username."""
+    tagged = chain(
+        ((friend, "active", "Friends") for friend in friends_json.get("Friends", [])),
+        ((friend, "deleted", "Deleted Friends") for friend in friends_json.get("Deleted Friends", []))
+    )
+    return {
+        friend["Username"]: {**_NOT_FOUND_FRIEND, **friend,
+                              "friend_status": status, "friend_list_section": section}
+        for friend, status, section in tagged
+    }
 
-    logger.warning("Could not determine account owner")
-    return "unknown"
+def utc_now_iso() -> str:
+    """Current UTC time as an ISO-8601 string with a 'Z' suffix."""
+    return datetime.now(timezone.utc).strftime('%Y-%m-%dT%H:%M:%S.%fZ')
+
+def participant_entry(username: str, friend: Dict) -> Participant:
+    """Build the participant record for username from its friends-map entry."""
+    return Participant(
+        username=username,
+        display_name=friend["Display Name"] or username,
+        creation_timestamp=friend["Creation Timestamp"],
+        last_modified_timestamp=friend["Last Modified Timestamp"],
+        source=friend["Source"],
+        friend_status=friend["friend_status"],
+        friend_list_section=friend["friend_list_section"]
+    )
 
 def create_conversation_metadata(conv_id: str, messages: List[Dict],
-                                friends_json: Dict, owner: str) -> Dict:
-    """Create metadata for a conversation."""
-    is_group = any(msg.get("Conversation Title") for msg in messages)
-
-    # Get participants inline
+                                friends_map: Dict[str, Dict], owner: str,
+                                index_created: Optional[str] = None) -> Dict:
+    """Create metadata for a conversation. Pass index_created to share one run timestamp."""
+    # Single pass: participants, message counts and group name
     participants = set()
+    snap_count = chat_count = 0
+    group_name = None
     for msg in messages:
+        msg_type = msg.get("Type")
+        if msg_type == "snap":
+            snap_count += 1
+        elif msg_type == "message":
+            chat_count += 1
+
         sender = msg.get("From")
         if sender:
             participants.add(sender)
 
+        if group_name is None and msg.get("Conversation Title"):
+            group_name = msg["Conversation Title"]
+
+    is_group = group_name is not None
     if not is_group:
         participants.add(conv_id)
     participants.discard(owner)
 
-    # Process friends inline
-    friends_map = {}
-    for friend in friends_json.get("Friends", []):
-        friend["friend_status"] = "active"
-        friend["friend_list_section"] = "Friends"
-        friends_map[friend["Username"]] = friend
-
-    for friend in friends_json.get("Deleted Friends", []):
-        friend["friend_status"] = "deleted"
-        friend["friend_list_section"] = "Deleted Friends"
-        friends_map[friend["Username"]] = friend
-
     # Build participant list
-    participants_list = []
-    for username in sorted(participants):
-        friend = friends_map.get(username, {})
-        participants_list.append({
-            "username": username,
-            "display_name": friend.get("Display Name", username),
-            "creation_timestamp": friend.get("Creation Timestamp", "N/A"),
-            "last_modified_timestamp": friend.get("Last Modified Timestamp", "N/A"),
-            "source": friend.get("Source", "unknown"),
-            "friend_status": friend.get("friend_status", "not_found"),
-            "friend_list_section": friend.get("friend_list_section", "Not Found"),
-            "is_owner": False
-        })
+    get_friend = friends_map.get
+    participants_list = [participant_entry(username, get_friend(username, _NOT_FOUND_FRIEND))
+                         for username in sorted(participants)]
 
     # Create metadata
     metadata = {
         "conversation_type": "group" if is_group else "individual",
         "conversation_id": conv_id,
         "total_messages": len(messages),
-        "snap_count": sum(1 for msg in messages if msg.get("Type") == "snap"),
-        "chat_count": sum(1 for msg in messages if msg.get("Type") == "message"),
+        "snap_count": snap_count,
+        "chat_count": chat_count,
         "participants": participants_list,
         "participant_count": len(participants_list),
         "account_owner": owner,
@@ -104,15 +136,12 @@ def create_conversation_metadata(conv_id: str, messages: List[Dict],
             "first_message": messages[0].get("Created", "N/A") if messages else "N/A",
             "last_message": messages[-1].get("Created", "N/A") if messages else "N/A"
         },
-        "index_created": datetime.now(timezone.utc).isoformat().replace('+00:00', 'Z')
+        "index_created": index_created or utc_now_iso()
     }
 
     # Add group name if applicable
     if is_group:
-        for msg in messages:
-            if msg.get("Conversation Title"):
-                metadata["group_name"] = msg["Conversation Title"]
-                break
+        metadata["group_name"] = group_name
 
     return metadata
 
@@ -126,8 +155,7 @@ def get_conversation_folder_name(metadata: Dict, messages: List[Dict]) -> str:
     if not base_name:
         participants = metadata.get("participants", [])
         if participants:
-            base_name = (participants[0].get("display_name") or
-                        participants[0].get("username"))
+            base_name = participants[0].display_name or participants[0].username
         else:
             base_name = metadata.get("conversation_id", "unknown")
 
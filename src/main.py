@@ -3,17 +3,24 @@
 
 import argparse
 import logging
-import shutil
+import os
+import re
 import sys
 import time
+from concurrent.futures import ThreadPoolExecutor, as_completed
 from pathlib import Path
 from typing import Dict, Set
+from tqdm import tqdm
 
 from config import (
     INPUT_DIR,
     OUTPUT_DIR,
+    MATERIALIZE_MODE,
+    MATERIALIZE_MODES,
     ensure_directory,
+    iter_json_items,
     load_json,
+    parallel_rmtree,
     save_json,
     sanitize_filename,
     safe_materialize,
@@ -30,16 +37,23 @@ from media_processing import (
 
 from conversation import (
     merge_conversations,
-    determine_account_owner,
+    build_friends_map,
     create_conversation_metadata,
+    utc_now_iso,
     get_conversation_folder_name
 )
 
+# Thumbnails (any case) and overlays are never written as orphans
+_ORPHAN_SKIP_RE = re.compile(r'(?i:thumbnail)|_overlay~')
+
 def find_export_folder(input_dir: Path) -> Path:
     """Find Snapchat export folder."""
-    for d in input_dir.iterdir():
-        if d.is_dir() and (d / "json").exists() and (d / "chat_media").exists():
-            return d
+    with os.scandir(input_dir) as it:
+        for entry in it:
+            # DirEntry.is_dir() reuses the d_type from readdir, no extra stat
+            if (entry.is_dir() and os.path.exists(os.path.join(entry.path, "json")) and
+                    os.path.exists(os.path.join(entry.path, "chat_media"))):
+                return Path(entry.path)
     
     raise FileNotFoundError(
         f"No valid Snapchat export found in '{input_dir}'. "
@@ -52,8 +66,10 @@ def process_conversation_media(conv_id: str, messages: list, mapping: dict,
     if not mapping:
         return
 
+    # Created by safe_materialize on first use
     media_dir = conv_dir / "media"
-    ensure_directory(media_dir)
+    # media_locations are relative to the conversation folder
+    location_prefix = media_dir.name + "/"
 
     for msg_idx, items in mapping.items():
         if msg_idx >= len(messages):
@@ -64,23 +80,37 @@ def process_conversation_media(conv_id: str, messages: list, mapping: dict,
 
         for item in items:
             media_file = item["media_file"]
-            dest = media_dir / media_file.filename
+            filename = media_file.filename
 
             # Handle single file
-            if safe_materialize(media_file.source_path, dest):
-                matched_files.append(media_file.filename)
-            location = f"media/{media_file.filename}"
-            media_locations.append(location)
+            if safe_materialize(media_file.source_path, media_dir / filename):
+                matched_files.append(filename)
+            media_locations.append(location_prefix + filename)
 
         # Update message
-        messages[msg_idx]["media_locations"] = media_locations
-        messages[msg_idx]["matched_media_files"] = matched_files
-        messages[msg_idx]["is_grouped"] = False  # All files are now individual
-        messages[msg_idx]["mapping_method"] = items[0]["mapping_method"]
-
-        if "time_diff_seconds" in items[0]:
-            messages[msg_idx]["time_diff_seconds"] = items[0]["time_diff_seconds"]
-
+        first = items[0]
+        update = {
+            "media_locations": media_locations,
+            "matched_media_files": matched_files,
+            "is_grouped": False,  # All files are now individual
+            "mapping_method": first["mapping_method"]
+        }
+        if "time_diff_seconds" in first:
+            update["time_diff_seconds"] = first["time_diff_seconds"]
+        messages[msg_idx].update(update)
+
+def write_conversation(conv_id: str, messages: list, metadata: dict, mapping: dict,
+                       conv_dir: Path) -> None:
+    """Materialize a conversation's media and save its conversation.json."""
+    # Process media
+    if mapping:
+        process_conversation_media(conv_id, messages, mapping, conv_dir)
+
+    # Save conversation data
+    save_json({
+        "conversation_metadata": metadata,
+        "messages": messages
+    }, conv_dir / "conversation.json")
 
 def main():
     """Main processing function."""
@@ -109,10 +139,14 @@ def main():
         logger.info("PHASE: INITIALIZATION")
         logger.info("=" * 60)
 
+        if MATERIALIZE_MODE not in MATERIALIZE_MODES:
+            raise ValueError(f"MATERIALIZE_MODE must be one of {', '.join(MATERIALIZE_MODES)}, "
+                             f"got '{MATERIALIZE_MODE}'")
+
         # Clean output if requested
         if not args.no_clean and args.output.exists():
             logger.info(f"Cleaning output directory: {args.output}")
-            shutil.rmtree(args.output)
+            parallel_rmtree(args.output)
 
         # Find export folder
         export_dir = find_export_folder(args.input)
@@ -138,16 +172,19 @@ def main():
         logger.info("PHASE: DATA LOADING AND PROCESSING")
         logger.info("=" * 60)
 
-        chat_data = load_json(json_dir / "chat_history.json")
-        snap_data = load_json(json_dir / "snap_history.json")
-        friends_json = load_json(json_dir / "friends.json")
+        # Read friends.json in the background while the histories stream into the merge
+        with ThreadPoolExecutor(max_workers=1) as executor:
+            friends_future = executor.submit(load_json, json_dir / "friends.json")
 
-        if not chat_data and not snap_data:
-            raise ValueError("No chat or snap data found")
+            # Process conversations
+            conversations, account_owner = merge_conversations(
+                iter_json_items(json_dir / "chat_history.json"),
+                iter_json_items(json_dir / "snap_history.json")
+            )
+            friends_map = build_friends_map(friends_future.result())
 
-        # Process conversations
-        conversations = merge_conversations(chat_data, snap_data)
-        account_owner = determine_account_owner(conversations)
+        if not conversations:
+            raise ValueError("No chat or snap data found")
 
         logger.info(f"Loaded {len(conversations)} conversations")
         stats.phase_times['data_loading'] = time.time() - phase_start
@@ -172,42 +209,55 @@ def main():
         ensure_directory(args.output)
 
         conversation_count = 0
-        materialized_files = set()
-
-        for conv_id, messages in conversations.items():
-            if not messages:
-                continue
-
-            # Create metadata
-            metadata = create_conversation_metadata(conv_id, messages, friends_json, account_owner)
-
-            # Create output directory
-            folder_name = get_conversation_folder_name(metadata, messages)
-            folder_name = sanitize_filename(folder_name)
-
-            is_group = metadata["conversation_type"] == "group"
-            base_dir = args.output / "groups" if is_group else args.output / "conversations"
-            conv_dir = base_dir / folder_name
-            ensure_directory(conv_dir)
-
-            # Process media
-            if conv_id in mappings:
-                process_conversation_media(
-                    conv_id, messages, mappings[conv_id],
-                    conv_dir
-                )
-                # Track materialized files
-                for items in mappings[conv_id].values():
-                    for item in items:
-                        materialized_files.add(item["media_file"].filename)
-
-            # Save conversation data
-            save_json({
-                "conversation_metadata": metadata,
-                "messages": messages
-            }, conv_dir / "conversation.json")
-
-            conversation_count += 1
+        index_created = utc_now_iso()
+        futures = []
+        pending_dirs = {}  # casefolded conv_dir -> future of the last write into it
+
+        # Metadata is built here; media and JSON writes run in worker threads
+        with ThreadPoolExecutor(max_workers=8) as executor:
+            try:
+                # Pop each conversation so its messages are released once written
+                for conv_id in list(conversations):
+                    messages = conversations.pop(conv_id)
+                    if not messages:
+                        continue
+
+                    # Create metadata
+                    metadata = create_conversation_metadata(
+                        conv_id, messages, friends_map, account_owner, index_created
+                    )
+
+                    # Create output directory
+                    folder_name = get_conversation_folder_name(metadata, messages)
+                    folder_name = sanitize_filename(folder_name)
+
+                    is_group = metadata["conversation_type"] == "group"
+                    base_dir = args.output / "groups" if is_group else args.output / "conversations"
+                    conv_dir = base_dir / folder_name
+
+                    # Conversations sharing a folder are written in their original order;
+                    # compare case-insensitively, as the filesystem may (e.g. macOS)
+                    dir_key = str(conv_dir).casefold()
+                    previous = pending_dirs.get(dir_key)
+                    if previous is not None:
+                        previous.result()
+
+                    mapping = mappings.get(conv_id)
+                    future = executor.submit(write_conversation, conv_id, messages, metadata,
+                                             mapping, conv_dir)
+                    pending_dirs[dir_key] = future
+                    futures.append(future)
+
+                with tqdm(total=len(futures), desc="Writing conversations", unit="convs") as pbar:
+                    for future in as_completed(futures):
+                        future.result()
+                        conversation_count += 1
+                        pbar.update(1)
+            except BaseException:
+                # Don't start queued writes once one has failed
+                for future in futures:
+                    future.cancel()
+                raise
 
         logger.info(f"Organized {conversation_count} conversations")
         stats.phase_times['output_organization'] = time.time() - phase_start
@@ -222,15 +272,15 @@ def main():
         orphaned_count = 0
 
         # Find and materialize orphaned files
-        for media_id, media_file in media_index.items():
-            if media_file.filename not in mapped_files:
-                # Skip thumbnails and overlays
-                if "thumbnail" in media_file.filename.lower() or "_overlay~" in media_file.filename:
-                    continue
+        for media_file in media_index.values():
+            filename = media_file.filename
+            # Skip mapped files, thumbnails and overlays
+            if filename in mapped_files or _ORPHAN_SKIP_RE.search(filename):
+                continue
 
-                ensure_directory(orphaned_dir)
-                if safe_materialize(media_file.source_path, orphaned_dir / media_file.filename):
-                    orphaned_count += 1
+            # safe_materialize creates orphaned_dir on first use
+            if safe_materialize(media_file.source_path, orphaned_dir / filename):
+                orphaned_count += 1
 
         stats.orphaned = orphaned_count
         logger.info(f"Processed {orphaned_count} orphaned media files")
@@ -247,7 +297,7 @@ def main():
         # Clean up temporary merged directory
         if temp_merged_dir.exists():
             logger.info(f"Removing temporary directory: {temp_merged_dir}")
-            shutil.rmtree(temp_merged_dir)
+            parallel_rmtree(temp_merged_dir)
 
         logger.info("Cleanup complete")
         stats.phase_times['cleanup'] = time.time() - phase_start
@@ -303,7 +353,7 @@ def main():
         # Clean up temporary merged directory on error
         if 'temp_merged_dir' in locals() and temp_merged_dir.exists():
             logger.info(f"Cleaning up temporary directory: {temp_merged_dir}")
-            shutil.rmtree(temp_merged_dir)
+            parallel_rmtree(temp_merged_dir)
 
         return 1
 
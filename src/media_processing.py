@@ -7,6 +7,7 @@ import os
 import re
 import shutil
 import struct
+from bisect import bisect_left, bisect_right
 from collections import defaultdict
 from datetime import datetime, timezone
 from pathlib import Path
@@ -21,6 +22,7 @@ from config import (
     MediaFile,
     Stats
 )
+from conversation import message_timestamp
 
 # Direct ffmpeg-python import for overlay merging
 import ffmpeg
@@ -32,6 +34,18 @@ logger = logging.getLogger(__name__)
 # Cache directory for converted PNG files
 CACHE_DIR = Path(".cache")
 
+# Leading YYYY-MM-DD date in export filenames
+_DATE_RE = re.compile(r'[0-9]{4}-[0-9]{2}-[0-9]{2}')
+
+# Media ID patterns in export filenames, tried in order by extract_media_id
+_B_ID_RE = re.compile(r'b~([^.]+)', re.I)
+_ZIP_ID_RE = re.compile(r'media~zip-([A-F0-9\-]+)', re.I)
+_MEDIA_ID_RE = re.compile(r'(media|overlay)~([A-F0-9\-]+)', re.I)
+
+def extract_date_from_filename(filename: str) -> Optional[str]:
+    """Extract the leading YYYY-MM-DD date from a filename."""
+    return filename[:10] if _DATE_RE.match(filename) else None
+
 def convert_webp_to_png_optimized(input_path: Path, output_path: Path) -> bool:
     """
     Convert a single WebP image to PNG efficiently.
@@ -129,12 +143,13 @@ def batch_convert_webp_overlays(overlay_files: List[Path], cache_dir: Path, max_
 
 def cleanup_cache_directory():
     """Clean up cache directory to free disk space."""
-    if CACHE_DIR.exists():
-        try:
-            shutil.rmtree(CACHE_DIR)
-            logger.info(f"Cleaned up cache directory: {CACHE_DIR}")
-        except Exception as e:
-            logger.warning(f"Failed to clean up cache directory: {e}")
+    try:
+        shutil.rmtree(CACHE_DIR)
+        logger.info(f"Cleaned up cache directory: {CACHE_DIR}")
+    except FileNotFoundError:
+        pass
+    except Exception as e:
+        logger.warning(f"Failed to clean up cache directory: {e}")
 
 def cleanup_process_pool():
     """Cleanup function for compatibility with existing code."""
@@ -268,27 +283,32 @@ def merge_overlay_pairs(source_dir: Path, output_dir: Path, max_workers: int = 8
     stats = {'total_media': 0, 'total_overlay': 0, 'total_merged': 0, 'webp_converted': 0}
     
     # Group files by date
-    files_by_date = defaultdict(lambda: {"media": [], "overlay": []})
+    files_by_date = {}
     for file_path in source_dir.iterdir():
         if not file_path.is_file():
             continue
         
-        match = re.match(r"(\d{4}-\d{2}-\d{2})", file_path.name)
-        if not match:
+        name = file_path.name
+        date_str = extract_date_from_filename(name)
+        if not date_str:
             continue
             
-        date_str = match.group(1)
-        name_lower = file_path.name.lower()
-        
-        if "thumbnail" in name_lower or "media~zip-" in file_path.name:
+        if "thumbnail" in name.lower() or "media~zip-" in name:
             continue
             
-        if "_media~" in file_path.name:
-            files_by_date[date_str]["media"].append(file_path)
+        if "_media~" in name:
+            kind = "media"
             stats['total_media'] += 1
-        elif "_overlay~" in file_path.name:
-            files_by_date[date_str]["overlay"].append(file_path)
+        elif "_overlay~" in name:
+            kind = "overlay"
             stats['total_overlay'] += 1
+        else:
+            continue
+
+        group = files_by_date.get(date_str)
+        if group is None:
+            group = files_by_date[date_str] = {"media": [], "overlay": []}
+        group[kind].append(file_path)
     
     # Collect all merge operations from all groups
     for date_str, files in files_by_date.items():
@@ -357,15 +377,15 @@ def extract_media_id(filename: str) -> Optional[str]:
         return None
 
     if 'b~' in filename:
-        match = re.search(r'b~([^.]+)', filename, re.I)
+        match = _B_ID_RE.search(filename)
         if match:
             return f'b~{match.group(1)}'
 
-    match = re.search(r'media~zip-([A-F0-9\-]+)', filename, re.I)
+    match = _ZIP_ID_RE.search(filename)
     if match:
         return f'media~zip-{match.group(1)}'
 
-    match = re.search(r'(media|overlay)~([A-F0-9\-]+)', filename, re.I)
+    match = _MEDIA_ID_RE.search(filename)
     if match:
         return f'{match.group(1)}~{match.group(2)}'
 
@@ -482,18 +502,16 @@ def map_media_to_messages(conversations: Dict[str, List], media_index: Dict[str,
                 media_ids = media_ids[:1]
 
             for media_id in media_ids:
-                if media_id in media_index:
-                    media_file = media_index[media_id]
-
-                    if i not in mappings[conv_id]:
-                        mappings[conv_id][i] = []
+                media_file = media_index.get(media_id)
+                if media_file is None:
+                    continue
 
-                    mappings[conv_id][i].append({
-                        "media_file": media_file,
-                        "mapping_method": "media_id"
-                    })
-                    mapped_files.add(media_file.filename)
-                    stats['mapped_by_id'] += 1
+                mappings[conv_id].setdefault(i, []).append({
+                    "media_file": media_file,
+                    "mapping_method": "media_id"
+                })
+                mapped_files.add(media_file.filename)
+                stats['mapped_by_id'] += 1
 
     # Phase 2: Map unmapped files by timestamp
     logger.info("Phase 2: Mapping by timestamp...")
@@ -502,10 +520,13 @@ def map_media_to_messages(conversations: Dict[str, List], media_index: Dict[str,
     msg_timestamps = []
     for conv_id, messages in conversations.items():
         for i, msg in enumerate(messages):
-            ts = int(msg.get("Created(microseconds)", 0))
+            ts = message_timestamp(msg)
             if ts > 0:
                 msg_timestamps.append((conv_id, i, ts))
     msg_timestamps.sort(key=lambda x: x[2])
+    # Parallel array of the sorted timestamps for binary search
+    msg_ts_values = [entry[2] for entry in msg_timestamps]
+    threshold_ms = TIMESTAMP_THRESHOLD_SECONDS * 1000
 
     # Map unmapped files with timestamps
     for media_id, media_file in media_index.items():
@@ -516,11 +537,10 @@ def map_media_to_messages(conversations: Dict[str, List], media_index: Dict[str,
             continue
 
         # Find all potential matches within threshold
-        potential_matches = []
-        for conv_id, msg_idx, msg_ts in msg_timestamps:
-            diff = abs(media_file.timestamp - msg_ts)
-            if diff <= TIMESTAMP_THRESHOLD_SECONDS * 1000:
-                potential_matches.append((conv_id, msg_idx, msg_ts, diff))
+        lo = bisect_left(msg_ts_values, media_file.timestamp - threshold_ms)
+        hi = bisect_right(msg_ts_values, media_file.timestamp + threshold_ms)
+        potential_matches = [(conv_id, msg_idx, msg_ts, abs(media_file.timestamp - msg_ts))
+                             for conv_id, msg_idx, msg_ts in msg_timestamps[lo:hi]]
         
         # Sort by timestamp difference
         potential_matches.sort(key=lambda x: x[3])
@@ -539,7 +559,8 @@ def map_media_to_messages(conversations: Dict[str, List], media_index: Dict[str,
                 
                 # For snap messages, check if already has media mapped
                 if msg_type == "snap":
-                    if msg_idx in mappings[conv_id] and len(mappings[conv_id][msg_idx]) > 0:
+                    # .get() avoids creating empty entries in the defaultdict
+                    if mappings.get(conv_id, {}).get(msg_idx):
                         # This snap already has media - keep as fallback if no empty snaps found
                         if fallback_match is None or diff < fallback_diff:
                             fallback_match = (conv_id, msg_idx)
@@ -568,10 +589,7 @@ def map_media_to_messages(conversations: Dict[str, List], media_index: Dict[str,
 
         if best_match and min_diff <= TIMESTAMP_THRESHOLD_SECONDS * 1000:
             conv_id, msg_idx = best_match
-            if msg_idx not in mappings[conv_id]:
-                mappings[conv_id][msg_idx] = []
-
-            mappings[conv_id][msg_idx].append({
+            mappings[conv_id].setdefault(msg_idx, []).append({
                 "media_file": media_file,
                 "mapping_method": "timestamp",
                 "time_diff_seconds": round(min_diff / 1000.0, 1)